@@ -1,13 +1,111 @@
 # app/api.py
 from __future__ import annotations
 
+import asyncio
+import copy
+import hashlib
+import os
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import AsyncIterator, Optional
+
+import anyio.to_thread
+import orjson
 import torch
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel, Field
-from fastapi.responses import HTMLResponse
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.exceptions import RequestValidationError
+from pydantic import BaseModel, Field, ValidationError
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from fastapi.staticfiles import StaticFiles
+from transformers import StoppingCriteria, StoppingCriteriaList, TextStreamer
 
 
-from .model import get_model, get_load_error
+from .batcher import DynamicBatcher
+from .model import cache_prompt_prefix, get_model, get_load_error
+
+
+STATIC_DIR = Path(__file__).resolve().parent / "static"
+
+BATCH_MAX_SIZE = int(os.environ.get("BATCH_MAX_SIZE", "8"))
+BATCH_MAX_DELAY = float(os.environ.get("BATCH_MAX_DELAY", "0.05"))
+
+# Prompt-lookup decoding: черновые токены берутся n-граммами из промпта
+# (шапка уже содержит "Вердикт: " и "Пояснение: "); 0 — выключено
+PROMPT_LOOKUP_TOKENS = int(os.environ.get("PROMPT_LOOKUP_TOKENS", "10"))
+
+# Внутри одного generate длина промптов отличается не более чем в столько раз:
+# иначе короткие строки тратят вычисления на паддинг до самого длинного промпта
+_MAX_PAD_RATIO = 2.0
+
+_VERDICT_RE = re.compile(r"^вердикт\s*:\s*(верно|неверно)\b", re.IGNORECASE | re.MULTILINE)
+_EXPL_RE = re.compile(r"^пояснение\s*:[ \t]*(.*)$", re.IGNORECASE | re.MULTILINE)
+_VERDICTS = {"верно": 1, "неверно": 0}
+# Строка пояснения дописана: после "Пояснение:" есть текст и перевод строки
+_EXPL_DONE_RE = re.compile(r"^пояснение\s*:[^\n]*\S[^\n]*\n", re.IGNORECASE | re.MULTILINE)
+
+# Общая для всех запросов шапка промпта — её KV-кэш считается один раз при старте
+_PROMPT_HEADER = (
+    "Ты — эксперт по проверке решений ЕГЭ по математике.\n"
+    "Верни ровно в таком формате:\n"
+    "Вердикт: верно|неверно\n"
+    "Пояснение: ...\n"
+    "\n"
+)
+_PROMPT_TMPL = _PROMPT_HEADER + "Условие:\n{condition}\n\nРешение ученика:\n{student_solution}"
+_REFERENCE_TMPL = "\n\nЭталонное решение:\n{}"
+_HINT_TMPL = "\n\nЭталонный ответ (подсказка): {}"
+
+# Вся генерация идёт в одном выделенном потоке: модель одна, а потоки пула
+# FastAPI остаются свободными для /health, /info и UI
+_INFERENCE_EXECUTOR: Optional[ThreadPoolExecutor] = None
+_BATCHER: Optional[DynamicBatcher] = None
+
+# Генерация детерминированная (do_sample=False), поэтому одинаковые запросы
+# отдаём из LRU-кэша по хэшу промпта и лимита токенов; 0 — кэш выключен
+RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", "512"))
+_RESPONSE_CACHE: OrderedDict[bytes, PredictResponse] = OrderedDict()
+
+# Лимит пула потоков anyio (по умолчанию 40). Генерация идёт в своём потоке, SSE-стримы —
+# в event loop, так что пул обслуживает только короткие sync-операции (StaticFiles)
+# и ни один запрос не держит поток на время генерации
+THREADPOOL_SIZE = int(os.environ.get("THREADPOOL_SIZE", "16"))
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global _BATCHER, _INFERENCE_EXECUTOR
+    anyio.to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+    m = get_model()
+    if m is not None:
+        cache_prompt_prefix(m, _PROMPT_HEADER)
+    # Бандл фиксируется один раз при старте; обработчики читают его из app.state
+    app.state.model_bundle = m
+    _INFERENCE_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="inference")
+    _BATCHER = DynamicBatcher(
+        _predict_batch,
+        # статический кэш и графы скомпилированной модели прогреты на батче из одного запроса:
+        # другой размер батча заново выделил бы кэш и перезахватил графы, а ждать добора незачем
+        max_batch_size=1 if m is not None and m.compiled else BATCH_MAX_SIZE,
+        max_delay=BATCH_MAX_DELAY,
+        executor=_INFERENCE_EXECUTOR,
+        split_fn=_split_batch,
+    )
+    _BATCHER.start()
+    _RESPONSE_CACHE.clear()
+    try:
+        yield
+    finally:
+        await _BATCHER.stop()
+        _BATCHER = None
+        _RESPONSE_CACHE.clear()
+        app.state.model_bundle = None
+        _INFERENCE_EXECUTOR.shutdown(wait=True)
+        _INFERENCE_EXECUTOR = None
 
 
 app = FastAPI(
@@ -24,7 +122,10 @@ app = FastAPI(
         "displayRequestDuration": True,
         "tryItOutEnabled": True,  # чтобы Try it out был доступен сразу
     },
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
 )
+app.state.model_bundle = None
 
 
 class PredictRequest(BaseModel):
@@ -126,313 +227,448 @@ class PredictResponse(BaseModel):
     }
 
 
-@app.on_event("startup")
-def _startup():
-    get_model()
-
-
 @app.get("/health", tags=["service"], summary="Health-check")
-def health():
-    m = get_model()
-    return {
+async def health():
+    m = app.state.model_bundle
+    return ORJSONResponse({
         "status": "ok",
         "model_loaded": m is not None,
         "model_source": None if m is None else m.source,
         "load_error": get_load_error(),
-    }
+    })
 
 
 @app.get("/info", tags=["service"], summary="Информация о модели/окружении")
-def info():
-    m = get_model()
-    return {
+async def info():
+    m = app.state.model_bundle
+    return ORJSONResponse({
         "model_loaded": m is not None,
         "model_source": None if m is None else m.source,
+        "backend": None if m is None else m.backend,
         "device": None if m is None else m.device,
         "dtype": None if m is None else str(m.dtype),
+        "quantization": None if m is None else m.quantization,
         "tokenizer": None if m is None else type(m.tokenizer).__name__,
+        "prefix_cache": None if m is None else m.prefix_cache is not None,
+        "prefix_error": None if m is None else m.prefix_error,
         "load_error": get_load_error(),
-    }
+    })
 
 
 def _build_prompt(req: PredictRequest) -> str:
-    parts = [
-        "Ты — эксперт по проверке решений ЕГЭ по математике.",
-        "Верни ровно в таком формате:",
-        "Вердикт: верно|неверно",
-        "Пояснение: ...",
-        "",
-        f"Условие:\n{req.condition.strip()}",
-        "",
-        f"Решение ученика:\n{req.student_solution.strip()}",
-    ]
-    if req.use_reference and req.reference_solution:
-        parts += ["", f"Эталонное решение:\n{req.reference_solution.strip()}"]
-    if req.answer_hint:
-        parts += ["", f"Эталонный ответ (подсказка): {req.answer_hint.strip()}"]
-    return "\n".join(parts).strip() + "\n"
+    prompt = (
+        _PROMPT_TMPL.format(
+            condition=req.condition.strip(),
+            student_solution=req.student_solution.strip(),
+        )
+        + (
+            _REFERENCE_TMPL.format(req.reference_solution.strip())
+            if req.use_reference and req.reference_solution
+            else ""
+        )
+        + (_HINT_TMPL.format(req.answer_hint.strip()) if req.answer_hint else "")
+    )
+    # rstrip — на случай пустого (из пробелов) последнего поля, как было со split/join
+    return prompt.rstrip() + "\n"
+
+
+def _match_verdict(line: str) -> str | None:
+    v = line.strip().lower()
+    for word in _VERDICTS:
+        rest = v[len(word):]
+        if v.startswith(word) and not (rest[:1].isalnum() or rest[:1] == "_"):
+            return word
+    return None
+
+
+def _partition_label(text: str, label: str, label_re: re.Pattern) -> str | None:
+    # Хвост строки после метки, если первое вхождение стоит в начале строки и выше нет
+    # такой же метки в другом регистре; иначе None — пусть решает регулярка
+    head, sep, tail = text.partition(label)
+    if not sep or (head and not head.endswith("\n")) or label_re.search(head):
+        return None
+    return tail.partition("\n")[0]
 
 
 def _parse_output(text: str) -> tuple[int, str, str]:
-    verdict = 0
-    verdict_text = "неверно"
-    explanation = ""
-
-    lower = text.lower()
-    if "вердикт:" in lower:
-        for line in text.splitlines():
-            if line.lower().startswith("вердикт:"):
-                v = line.split(":", 1)[1].strip().lower()
-                if "верно" in v and "неверно" not in v:
-                    verdict = 1
-                    verdict_text = "верно"
-                else:
-                    verdict = 0
-                    verdict_text = "неверно"
-                break
-
-    if "пояснение:" in lower:
-        for line in text.splitlines():
-            if line.lower().startswith("пояснение:"):
-                explanation = line.split(":", 1)[1].strip()
-                break
-
-    return verdict, verdict_text, explanation
+    # Быстрый путь — str.partition по меткам в точном написании из промпта (поиск в C,
+    # без .lower() всего текста); регулярки без учёта регистра — если быстрый путь не сработал
+    line = _partition_label(text, "Вердикт:", _VERDICT_RE)
+    verdict_text = _match_verdict(line) if line is not None else None
+    if verdict_text is None:
+        m = _VERDICT_RE.search(text)
+        verdict_text = m.group(1).lower() if m else "неверно"
+
+    line = _partition_label(text, "Пояснение:", _EXPL_RE)
+    if line is not None:
+        explanation = line.strip()
+    else:
+        m = _EXPL_RE.search(text)
+        explanation = m.group(1).strip() if m else ""
+
+    return _VERDICTS[verdict_text], verdict_text, explanation
+
+
+def _tokenize_with_prefix(m, prompts: list[str]) -> dict:
+    """
+    Токенизирует только хвост промптов после общего префикса и дописывает
+    закэшированный префикс слева. Паддинг оказывается между префиксом и хвостом:
+    attention_mask его маскирует, а position_ids generate выводит из маски сам.
+    """
+    tails = [p[len(m.prefix):] for p in prompts]
+    enc = m.tokenizer(tails, return_tensors="pt", padding=True, add_special_tokens=False).to(
+        m.model.device, non_blocking=True
+    )
+    prefix_ids = m.prefix_ids.expand(len(prompts), -1)
 
+    cache = copy.deepcopy(m.prefix_cache)
+    if len(prompts) > 1:
+        cache.batch_repeat_interleave(len(prompts))
 
-@app.post(
-    "/predict",
-    response_model=PredictResponse,
-    tags=["inference"],
-    summary="Проверить решение",
-    description="Проверяет решение ученика и возвращает вердикт и пояснение.",
-)
-def predict(req: PredictRequest):
-    m = get_model()
-    if m is None:
-        raise HTTPException(
-            status_code=503,
-            detail=f"Model is not available. load_error={get_load_error()}",
+    return {
+        "input_ids": torch.cat([prefix_ids, enc["input_ids"]], dim=1),
+        "attention_mask": torch.cat([torch.ones_like(prefix_ids), enc["attention_mask"]], dim=1),
+        "past_key_values": cache,
+    }
+
+
+class _StopAfterExplanation(StoppingCriteria):
+    """
+    Останавливает строку батча, как только модель выдала обе строки ответа
+    (вердикт и пояснение до перевода строки) — дальше _parse_output ничего не читает.
+    """
+
+    # Сколько последних токенов смотреть в поисках перевода строки: за шаг
+    # prompt-lookup decoding может принять сразу несколько токенов
+    _TAIL = 16
+
+    def __init__(self, tokenizer, prompt_len: int):
+        self.tokenizer = tokenizer
+        self.prompt_len = prompt_len
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        generated = input_ids[:, self.prompt_len:]
+        tails = self.tokenizer.batch_decode(generated[:, -self._TAIL:], skip_special_tokens=True)
+
+        done = []
+        for row, tail in zip(generated, tails):
+            # полный текст декодируем, только если в хвосте появился перевод строки
+            if "\n" not in tail:
+                done.append(False)
+                continue
+            text = self.tokenizer.decode(row, skip_special_tokens=True)
+            done.append(_VERDICT_RE.search(text) is not None and _EXPL_DONE_RE.search(text) is not None)
+        return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
+
+
+def _hf_generate_kwargs(m, prompts: list[str]) -> dict:
+    if m.prefix_cache is not None and all(p.startswith(m.prefix) for p in prompts):
+        inputs = _tokenize_with_prefix(m, prompts)
+    else:
+        # tokenizer настроен на паддинг слева — новые токены у всех строк начинаются с одной позиции.
+        # position_ids не передаём: generate сам строит их как attention_mask.cumsum(-1) - 1,
+        # так что позиции реальных токенов не сдвигаются паддингом (явные сломали бы decode-шаги)
+        inputs = m.tokenizer(prompts, return_tensors="pt", padding=True).to(
+            m.model.device, non_blocking=True
         )
 
-    prompt = _build_prompt(req)
+    # assisted-генерация в transformers работает только с batch_size=1 и без статического кэша
+    if PROMPT_LOOKUP_TOKENS > 0 and len(prompts) == 1 and not m.compiled:
+        inputs["prompt_lookup_num_tokens"] = PROMPT_LOOKUP_TOKENS
+
+    prompt_len = inputs["input_ids"].shape[1]
+    return dict(
+        inputs,
+        do_sample=False,
+        eos_token_id=m.tokenizer.eos_token_id,
+        pad_token_id=m.tokenizer.pad_token_id,
+        stopping_criteria=StoppingCriteriaList([_StopAfterExplanation(m.tokenizer, prompt_len)]),
+    )
 
-    inputs = m.tokenizer(prompt, return_tensors="pt")
-    inputs = {k: v.to(m.model.device) for k, v in inputs.items()}
 
+def _length_groups(prompts: list[str]) -> list[list[int]]:
+    """
+    Разбивает батч на группы индексов с близкой длиной промпта (по символам —
+    дёшево и достаточно точно для оценки паддинга). Выбросы по длине уходят в свою группу.
+    """
+    order = sorted(range(len(prompts)), key=lambda i: len(prompts[i]))
+    groups: list[list[int]] = []
+    for i in order:
+        if groups and len(prompts[i]) <= _MAX_PAD_RATIO * len(prompts[groups[-1][0]]):
+            groups[-1].append(i)
+        else:
+            groups.append([i])
+    return groups
+
+
+def _generate_hf(m, prompts: list[str], reqs: list[PredictRequest]) -> list[str]:
+    kwargs = _hf_generate_kwargs(m, prompts)
+    input_len = kwargs["input_ids"].shape[1]
+
+    max_new_tokens = max(r.max_new_tokens for r in reqs)
     with torch.no_grad():
-        out = m.model.generate(
-            **inputs,
-            max_new_tokens=req.max_new_tokens,
-            do_sample=False,
-            eos_token_id=m.tokenizer.eos_token_id,
-            pad_token_id=m.tokenizer.pad_token_id,
-        )
+        out = m.model.generate(**kwargs, max_new_tokens=max_new_tokens)
 
-    text = m.tokenizer.decode(out[0], skip_special_tokens=True)
-    raw = text[len(prompt):].strip() if text.startswith(prompt) else text.strip()
+    # общий лимит — максимум по батчу, поэтому режем до лимита конкретного запроса
+    return [
+        m.tokenizer.decode(row[input_len:input_len + req.max_new_tokens], skip_special_tokens=True).strip()
+        for row, req in zip(out, reqs)
+    ]
+
+
+def _generate_vllm(m, prompts: list[str], reqs: list[PredictRequest]) -> list[str]:
+    from vllm import SamplingParams
+
+    params = [SamplingParams(max_tokens=r.max_new_tokens, temperature=0) for r in reqs]
+    outs = m.model.generate(prompts, params, use_tqdm=False)
+    return [o.outputs[0].text.strip() for o in outs]
+
+
+def _cache_key(prompt: str, max_new_tokens: int) -> bytes:
+    # blake2b, а не hash(): ключ стабилен между процессами (пригодится для внешнего кэша)
+    h = hashlib.blake2b(prompt.encode("utf-8"), digest_size=16)
+    h.update(max_new_tokens.to_bytes(4, "little"))
+    return h.digest()
+
+
+def _cache_get(key: bytes) -> Optional[PredictResponse]:
+    resp = _RESPONSE_CACHE.get(key)
+    if resp is not None:
+        _RESPONSE_CACHE.move_to_end(key)
+    return resp
+
+
+def _cache_put(key: bytes, resp: PredictResponse) -> None:
+    if RESPONSE_CACHE_SIZE <= 0:
+        return
+    _RESPONSE_CACHE[key] = resp
+    _RESPONSE_CACHE.move_to_end(key)
+    if len(_RESPONSE_CACHE) > RESPONSE_CACHE_SIZE:
+        _RESPONSE_CACHE.popitem(last=False)
 
-    verdict, verdict_text, explanation = _parse_output(raw)
 
+def _make_response(raw: str) -> PredictResponse:
+    verdict, verdict_text, explanation = _parse_output(raw)
     return PredictResponse(
         verdict=verdict,
         verdict_text=verdict_text,
         explanation=explanation,
         raw=raw,
     )
-UI_HTML = """
-<!doctype html>
-<html lang="ru">
-<head>
-  <meta charset="utf-8" />
-  <meta name="viewport" content="width=device-width,initial-scale=1" />
-  <title>EGE Solution Checker</title>
-  <style>
-    :root { --bg:#0b1220; --card:#0f1b33; --muted:#9bb0d0; --text:#e7efff; --accent:#4da3ff; --ok:#41d17a; --bad:#ff5a6a; }
-    body { margin:0; font-family: ui-sans-serif, system-ui, -apple-system, Segoe UI, Roboto, Arial; background: radial-gradient(1200px 700px at 20% 0%, #14254a 0%, var(--bg) 50%); color:var(--text); }
-    .wrap { max-width: 980px; margin: 0 auto; padding: 28px 16px 60px; }
-    .top { display:flex; gap:14px; align-items:center; justify-content:space-between; flex-wrap:wrap; }
-    .title { font-size: 28px; font-weight: 800; letter-spacing: .2px; }
-    .subtitle { color:var(--muted); margin-top:6px; line-height:1.4; }
-    .badge { padding:6px 10px; border:1px solid rgba(255,255,255,.12); border-radius:999px; color:var(--muted); font-size:12px; }
-    .grid { display:grid; grid-template-columns: 1fr 1fr; gap: 14px; margin-top: 18px; }
-    @media (max-width: 900px) { .grid { grid-template-columns: 1fr; } }
-    .card { background: rgba(15,27,51,.85); border: 1px solid rgba(255,255,255,.08); border-radius: 16px; padding: 16px; box-shadow: 0 10px 30px rgba(0,0,0,.25); }
-    label { display:block; color: var(--muted); font-size: 13px; margin: 4px 0 6px; }
-    textarea, input[type="text"], input[type="number"] {
-      width:100%; box-sizing:border-box;
-      background: rgba(7,12,24,.6); color: var(--text);
-      border: 1px solid rgba(255,255,255,.10);
-      border-radius: 12px; padding: 12px;
-      outline: none;
-    }
-    textarea { min-height: 140px; resize: vertical; }
-    .row { display:flex; gap: 10px; align-items:center; flex-wrap:wrap; }
-    .row > * { flex: 1; }
-    .row .small { flex: 0 0 auto; }
-    .btn {
-      background: linear-gradient(180deg, rgba(77,163,255,.95), rgba(77,163,255,.75));
-      border: 0; color:#061025; font-weight: 800;
-      padding: 12px 14px; border-radius: 12px; cursor:pointer;
-      transition: transform .08s ease;
-    }
-    .btn:disabled { opacity:.55; cursor:not-allowed; }
-    .btn:active { transform: translateY(1px); }
-    .muted { color: var(--muted); font-size: 12px; }
-    .out { white-space: pre-wrap; line-height: 1.5; }
-    .verdict { display:inline-flex; gap:8px; align-items:center; padding:8px 10px; border-radius:999px; font-weight:800; }
-    .verdict.ok { background: rgba(65,209,122,.16); color: var(--ok); border:1px solid rgba(65,209,122,.25); }
-    .verdict.bad{ background: rgba(255,90,106,.16); color: var(--bad); border:1px solid rgba(255,90,106,.25); }
-    .hr { height:1px; background: rgba(255,255,255,.08); margin: 12px 0; }
-    .footer { margin-top: 14px; color: var(--muted); font-size: 12px; }
-    .link { color: var(--accent); text-decoration: none; }
-  </style>
-</head>
-<body>
-  <div class="wrap">
-    <div class="top">
-      <div>
-        <div class="title">Проверка решения ЕГЭ (MVP)</div>
-        <div class="subtitle">Вставьте условие и решение. Нажмите «Проверить» — получите вердикт и объяснение.</div>
-      </div>
-      <div class="badge" id="status">Проверяем статус модели…</div>
-    </div>
-
-    <div class="grid">
-      <div class="card">
-        <div class="row">
-          <div>
-            <label>Условие</label>
-            <textarea id="condition" placeholder="Вставьте условие задачи..."></textarea>
-          </div>
-        </div>
-
-        <div class="row" style="margin-top:10px;">
-          <div>
-            <label>Решение ученика</label>
-            <textarea id="student_solution" placeholder="Вставьте решение ученика..."></textarea>
-          </div>
-        </div>
-
-        <div class="row" style="margin-top:10px;">
-          <div>
-            <label>Эталонное решение (необязательно)</label>
-            <textarea id="reference_solution" placeholder="Если есть — вставьте эталон..."></textarea>
-          </div>
-        </div>
-
-        <div class="row" style="margin-top:10px;">
-          <div class="small" style="display:flex; gap:10px; align-items:center;">
-            <input id="use_reference" type="checkbox" checked />
-            <label for="use_reference" style="margin:0;">Учитывать эталон</label>
-          </div>
-          <div>
-            <label>Подсказка ответа (необязательно)</label>
-            <input id="answer_hint" type="text" placeholder="например, 105" />
-          </div>
-          <div>
-            <label>max_new_tokens</label>
-            <input id="max_new_tokens" type="number" min="1" max="1024" value="220" />
-          </div>
-        </div>
-
-        <div class="row" style="margin-top:12px;">
-          <button class="btn" id="btn" onclick="runCheck()">Проверить</button>
-          <div class="muted" id="hint">Ответ придёт в читаемом виде (не JSON).</div>
-        </div>
-      </div>
-
-      <div class="card">
-        <div style="display:flex; justify-content:space-between; align-items:center; gap:10px; flex-wrap:wrap;">
-          <div style="font-weight:800; font-size:16px;">Результат</div>
-          <div id="verdictBadge" class="verdict" style="display:none;"></div>
-        </div>
-        <div class="hr"></div>
-        <div id="explanation" class="out muted">Пока пусто. Нажмите «Проверить».</div>
-
-        <div class="footer">
-          Для разработчиков доступно <a class="link" href="/docs">/docs</a>.
-        </div>
-      </div>
-    </div>
-  </div>
-
-  <script>
-    async function refreshStatus() {
-      try {
-        const r = await fetch("/health");
-        const j = await r.json();
-        const el = document.getElementById("status");
-        if (j.model_loaded) {
-          el.textContent = "Модель готова: " + (j.model_source || "loaded");
-          el.style.borderColor = "rgba(65,209,122,.35)";
-          el.style.color = "#baf7d0";
-        } else {
-          el.textContent = "Модель не загружена: " + (j.load_error || "unknown");
-          el.style.borderColor = "rgba(255,90,106,.35)";
-          el.style.color = "#ffd0d5";
-        }
-      } catch (e) {
-        document.getElementById("status").textContent = "Статус недоступен";
-      }
-    }
 
-    function setLoading(isLoading) {
-      const b = document.getElementById("btn");
-      b.disabled = isLoading;
-      b.textContent = isLoading ? "Проверяем…" : "Проверить";
-    }
 
-    function showResult(verdict, verdictText, explanation) {
-      const badge = document.getElementById("verdictBadge");
-      badge.style.display = "inline-flex";
-      badge.className = "verdict " + (verdict === 1 ? "ok" : "bad");
-      badge.textContent = verdict === 1 ? "Верно" : "Неверно";
+def _split_batch(reqs: list[PredictRequest]) -> list[list[int]]:
+    # Каждая группа длин — отдельный вызов _predict_batch: короткие запросы получают ответ,
+    # не дожидаясь выброса по длине, а его ошибка (например, OOM) не задевает остальных.
+    # vLLM выравнивает батч сам (continuous batching), ему батч отдаём целиком
+    m = app.state.model_bundle
+    if m is None or m.backend == "vllm":
+        return [list(range(len(reqs)))]
+    return _length_groups([_build_prompt(r) for r in reqs])
 
-      const out = document.getElementById("explanation");
-      out.className = "out";
-      out.textContent = explanation || "(пояснение пустое)";
-    }
 
-    async function runCheck() {
-      setLoading(true);
-      const payload = {
-        condition: document.getElementById("condition").value || "",
-        student_solution: document.getElementById("student_solution").value || "",
-        reference_solution: document.getElementById("reference_solution").value || null,
-        use_reference: document.getElementById("use_reference").checked,
-        answer_hint: document.getElementById("answer_hint").value || null,
-        max_new_tokens: Number(document.getElementById("max_new_tokens").value || 220)
-      };
-
-      try {
-        const r = await fetch("/predict", {
-          method: "POST",
-          headers: { "Content-Type": "application/json" },
-          body: JSON.stringify(payload)
-        });
-
-        if (!r.ok) {
-          const t = await r.text();
-          showResult(0, "error", "Ошибка сервера: " + t);
-          return;
-        }
+def _predict_batch(reqs: list[PredictRequest]) -> list[PredictResponse]:
+    m = app.state.model_bundle
+    if m is None:
+        raise HTTPException(
+            status_code=503,
+            detail=f"Model is not available. load_error={get_load_error()}",
+        )
+
+    prompts = [_build_prompt(r) for r in reqs]
+    generate = _generate_vllm if m.backend == "vllm" else _generate_hf
+    return [_make_response(raw) for raw in generate(m, prompts, reqs)]
+
+
+class _StopOnEvent(StoppingCriteria):
+    """Останавливает генерацию, когда выставлен флаг (клиент стрима отключился)."""
+
+    def __init__(self, event: threading.Event):
+        self.event = event
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        return torch.full((input_ids.shape[0],), self.event.is_set(), dtype=torch.bool, device=input_ids.device)
+
+
+class _QueueStreamer(TextStreamer):
+    """
+    Стример, который из потока инференса кладёт куски текста в asyncio.Queue
+    event loop'а; None в очереди — конец генерации.
+    """
+
+    def __init__(self, tokenizer, loop: asyncio.AbstractEventLoop, queue: asyncio.Queue):
+        super().__init__(tokenizer, skip_prompt=True, skip_special_tokens=True)
+        self.loop = loop
+        self.queue = queue
+
+    def on_finalized_text(self, text: str, stream_end: bool = False):
+        if text:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, text)
+        if stream_end:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, None)
+
+
+def _generate_hf_streaming(
+    m, prompt: str, req: PredictRequest, streamer: _QueueStreamer, cancel: threading.Event
+) -> None:
+    try:
+        if cancel.is_set():
+            # клиент ушёл, пока запрос ждал своей очереди в потоке инференса
+            return
+        kwargs = _hf_generate_kwargs(m, [prompt])
+        kwargs["stopping_criteria"].append(_StopOnEvent(cancel))
+        with torch.no_grad():
+            m.model.generate(**kwargs, max_new_tokens=req.max_new_tokens, streamer=streamer)
+    finally:
+        streamer.end()  # иначе читатель очереди так и будет ждать следующий кусок
+
+
+def _sse(payload: dict) -> bytes:
+    return b"data: " + orjson.dumps(payload) + b"\n\n"
+
+
+async def _cached_events(resp: PredictResponse) -> AsyncIterator[bytes]:
+    yield _sse({"delta": resp.raw})
+    yield _sse({"done": True, **resp.model_dump()})
+
+
+async def _stream_events(m, req: PredictRequest, key: bytes) -> AsyncIterator[bytes]:
+    """
+    SSE-события: {"delta": ...} по мере генерации, в конце — {"done": true, ...PredictResponse}
+    или {"error": ...}. Генерация идёт в том же потоке инференса, что и батчи /predict;
+    сам генератор работает в event loop и потоков пула не занимает.
+    """
+    loop = asyncio.get_running_loop()
+    prompt = _build_prompt(req)
 
-        const j = await r.json();
-        showResult(j.verdict, j.verdict_text, j.explanation);
-      } catch (e) {
-        showResult(0, "error", "Сетевая ошибка: " + (e?.message || e));
-      } finally {
-        setLoading(false);
-      }
+    if m.backend == "vllm":
+        # vllm.LLM не стримит — отдаём ответ одним куском
+        try:
+            raw = (await loop.run_in_executor(_INFERENCE_EXECUTOR, _generate_vllm, m, [prompt], [req]))[0]
+        except Exception as e:
+            yield _sse({"error": f"{type(e).__name__}: {e}"})
+            return
+        yield _sse({"delta": raw})
+    else:
+        queue: asyncio.Queue = asyncio.Queue()
+        cancel = threading.Event()
+        streamer = _QueueStreamer(m.tokenizer, loop, queue)
+        fut = loop.run_in_executor(_INFERENCE_EXECUTOR, _generate_hf_streaming, m, prompt, req, streamer, cancel)
+        try:
+            chunks = []
+            while (chunk := await queue.get()) is not None:
+                chunks.append(chunk)
+                yield _sse({"delta": chunk})
+            try:
+                await fut
+            except Exception as e:
+                yield _sse({"error": f"{type(e).__name__}: {e}"})
+                return
+        finally:
+            # отключение клиента (CancelledError/GeneratorExit) — останавливаем генерацию,
+            # чтобы она не держала поток инференса до max_new_tokens
+            cancel.set()
+        raw = "".join(chunks).strip()
+
+    resp = _make_response(raw)
+    _cache_put(key, resp)
+    yield _sse({"done": True, **resp.model_dump()})
+
+
+# Тело /predict валидируем сами из сырых байт (PredictRequest.model_validate_json),
+# минуя json.loads → dict → валидацию в FastAPI; схема для Swagger задаётся явно
+_PREDICT_REQUEST_BODY = {
+    "requestBody": {
+        "required": True,
+        "content": {"application/json": {"schema": PredictRequest.model_json_schema()}},
     }
+}
+
+
+async def _read_predict_request(request: Request) -> PredictRequest:
+    body = await request.body()
+    try:
+        return PredictRequest.model_validate_json(body)
+    except ValidationError as e:
+        errors = e.errors(include_url=False)
+
+    if any(err["type"] == "json_invalid" for err in errors):
+        try:
+            body.decode("utf-8")
+        except UnicodeDecodeError:
+            # как FastAPI: тело не в UTF-8 — 400, а не 422
+            raise HTTPException(status_code=400, detail="There was an error parsing the body")
+    # тот же 422, что FastAPI отдаёт для невалидного тела
+    for err in errors:
+        err["loc"] = ("body", *err["loc"])
+        if err["type"] == "json_invalid":
+            err["input"] = {}  # там сырое тело (bytes): его не эхаем, а jsonable_encoder на нём падает
+    raise RequestValidationError(errors)
+
+
+@app.post(
+    "/predict",
+    response_model=PredictResponse,
+    tags=["inference"],
+    summary="Проверить решение",
+    description="Проверяет решение ученика и возвращает вердикт и пояснение.",
+    openapi_extra=_PREDICT_REQUEST_BODY,
+)
+async def predict(request: Request):
+    req = await _read_predict_request(request)
+    m = app.state.model_bundle
+    if m is None or _BATCHER is None:
+        raise HTTPException(
+            status_code=503,
+            detail=f"Model is not available. load_error={get_load_error()}",
+        )
+
+    key = _cache_key(_build_prompt(req), req.max_new_tokens)
+    resp = _cache_get(key)
+    if resp is None:
+        resp = await _BATCHER.process_batched(req)
+        _cache_put(key, resp)
+    # ответ уже провалидирован как PredictResponse — сериализуем напрямую через orjson
+    return ORJSONResponse(resp.model_dump())
 
-    refreshStatus();
-  </script>
-</body>
-</html>
-"""
 
-@app.get("/", include_in_schema=False, response_class=HTMLResponse)
-def landing():
-    return HTMLResponse(UI_HTML)
+@app.post(
+    "/predict/stream",
+    tags=["inference"],
+    summary="Проверить решение (стриминг)",
+    description=(
+        "То же, что /predict, но ответ приходит потоком Server-Sent Events: "
+        "события `{\"delta\": ...}` по мере генерации и финальное `{\"done\": true, ...}` "
+        "с полями PredictResponse. Запрос идёт мимо батчера (по одному), поэтому "
+        "основной путь — /predict, а стриминг — опция для клиентов, которым важно время до первого токена."
+    ),
+    response_class=StreamingResponse,
+    openapi_extra=_PREDICT_REQUEST_BODY,
+)
+async def predict_stream(request: Request):
+    req = await _read_predict_request(request)
+    m = app.state.model_bundle
+    if m is None or _INFERENCE_EXECUTOR is None:
+        raise HTTPException(
+            status_code=503,
+            detail=f"Model is not available. load_error={get_load_error()}",
+        )
+
+    key = _cache_key(_build_prompt(req), req.max_new_tokens)
+    cached = _cache_get(key)
+    events = _cached_events(cached) if cached is not None else _stream_events(m, req, key)
+
+    return StreamingResponse(
+        events,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+# UI — статическая страница app/static/index.html. Монтируется последним,
+# чтобы не перекрывать API-маршруты; сжимается gzip только статика (не SSE-стрим)
+app.mount(
+    "/",
+    GZipMiddleware(StaticFiles(directory=STATIC_DIR, html=True), minimum_size=500),
+    name="ui",
+)
@@ -0,0 +1,117 @@
+# app/batcher.py
+from __future__ import annotations
+
+import asyncio
+from concurrent.futures import Executor
+from typing import Callable, Generic, Optional, Sequence, TypeVar
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+class DynamicBatcher(Generic[T, R]):
+    """
+    Собирает конкурентные запросы в батч и отдаёт его одной функции инференса.
+
+    Батч уходит в работу, когда набралось max_batch_size элементов
+    или прошло max_delay секунд с момента прихода первого из них.
+    infer_fn — синхронная функция: list[T] -> list[R] (в том же порядке),
+    выполняется в executor (по умолчанию — в пуле потоков loop),
+    чтобы не блокировать event loop. Если батч упал, его элементы
+    прогоняются по одному, и ошибку получают только те, на ком она повторилась.
+
+    split_fn (опционально) делит собранный батч на группы индексов: каждая группа
+    уходит в infer_fn отдельным вызовом, и её запросы получают ответ сразу по готовности.
+    """
+
+    def __init__(
+        self,
+        infer_fn: Callable[[list[T]], Sequence[R]],
+        max_batch_size: int = 8,
+        max_delay: float = 0.05,
+        executor: Optional[Executor] = None,
+        split_fn: Optional[Callable[[list[T]], list[list[int]]]] = None,
+    ):
+        self._infer_fn = infer_fn
+        self._split_fn = split_fn
+        self._executor = executor
+        self._max_batch_size = max_batch_size
+        self._max_delay = max_delay
+        self._queue: asyncio.Queue[tuple[T, asyncio.Future]] = asyncio.Queue()
+        self._worker: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self._worker is None:
+            self._worker = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._worker is None:
+            return
+        self._worker.cancel()
+        try:
+            await self._worker
+        except asyncio.CancelledError:
+            pass
+        self._worker = None
+
+    async def process_batched(self, item: T) -> R:
+        fut = asyncio.get_running_loop().create_future()
+        await self._queue.put((item, fut))
+        return await fut
+
+    async def _collect(self) -> list[tuple[T, asyncio.Future]]:
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self._max_delay
+
+        while len(batch) < self._max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            # asyncio.wait вместо wait_for: на 3.10 wait_for может потерять
+            # элемент очереди, если get() завершился одновременно с таймаутом
+            getter = loop.create_task(self._queue.get())
+            try:
+                done, _ = await asyncio.wait({getter}, timeout=timeout)
+            except asyncio.CancelledError:
+                getter.cancel()
+                raise
+            if getter not in done:
+                getter.cancel()  # незавершённый get() оставляет элемент в очереди
+                break
+            batch.append(getter.result())
+
+        # клиенты, которые успели отвалиться, в батч не идут
+        return [(item, fut) for item, fut in batch if not fut.done()]
+
+    async def _run(self) -> None:
+        while True:
+            batch = await self._collect()
+            if not batch:
+                continue
+            if self._split_fn is None:
+                await self._dispatch(batch)
+                continue
+            for group in self._split_fn([item for item, _ in batch]):
+                await self._dispatch([batch[i] for i in group])
+
+    async def _dispatch(self, batch: list[tuple[T, asyncio.Future]]) -> None:
+        loop = asyncio.get_running_loop()
+        items = [item for item, _ in batch]
+        try:
+            results = await loop.run_in_executor(self._executor, self._infer_fn, items)
+        except Exception as e:
+            if len(batch) == 1:
+                if not batch[0][1].done():
+                    batch[0][1].set_exception(e)
+                return
+            # ошибку мог вызвать один запрос (например, OOM на слишком длинном) —
+            # повторяем по одному, чтобы она досталась только ему, а не всему батчу
+            for entry in batch:
+                if not entry[1].done():
+                    await self._dispatch([entry])
+            return
+
+        for (_, fut), result in zip(batch, results):
+            if not fut.done():
+                fut.set_result(result)
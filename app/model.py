@@ -2,25 +2,45 @@
 from __future__ import annotations
 
 import os
+import threading
 from dataclasses import dataclass
 from pathlib import Path
 from typing import Optional
 
 import torch
-from transformers import AutoModelForCausalLM, AutoTokenizer
+from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig
 
 
 @dataclass
 class ModelBundle:
-    model: torch.nn.Module
+    model: object  # torch.nn.Module для BACKEND=hf, vllm.LLM для BACKEND=vllm
     tokenizer: object
     device: str
     dtype: torch.dtype
     source: str
+    compiled: bool = False
+    quantization: Optional[str] = None
+    backend: str = "hf"
+    # KV-кэш общего префикса промпта (см. cache_prompt_prefix)
+    prefix: Optional[str] = None
+    prefix_ids: Optional[torch.Tensor] = None
+    prefix_cache: Optional[object] = None
+    prefix_error: Optional[str] = None
 
 
+# "hf" — transformers.generate, "vllm" — vllm.LLM (PagedAttention, continuous batching)
+BACKEND = os.environ.get("BACKEND", "hf").strip().lower()
+# Статический KV-кэш + torch.compile: долгий старт, зато decode-шаг идёт одним графом
+USE_COMPILE = os.environ.get("USE_COMPILE", "0") == "1"
+MAX_CTX = int(os.environ.get("MAX_CTX", "2048"))
+# FlashAttention-2 (нужны пакет flash-attn и CUDA); по умолчанию — SDPA
+USE_FLASH = os.environ.get("USE_FLASH", "0") == "1"
+# Квантизация весов через bitsandbytes (только CUDA): "int8" | "nf4"
+QUANT = os.environ.get("QUANT", "").strip().lower() or None
+
 _MODEL: Optional[ModelBundle] = None
 _LOAD_ERROR: Optional[str] = None
+_LOAD_LOCK = threading.Lock()
 
 
 def get_load_error() -> str | None:
@@ -28,6 +48,8 @@ def get_load_error() -> str | None:
 
 
 def _pick_device_and_dtype() -> tuple[str, torch.dtype]:
+    if torch.cuda.is_available():
+        return "cuda", torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
     # Mac: предпочтительно MPS, иначе CPU
     if torch.backends.mps.is_available():
         return "mps", torch.float16
@@ -64,43 +86,200 @@ def _resolve_source() -> tuple[str, bool]:
     return model_source, False
 
 
+def _quantization_config(device: str, dtype: torch.dtype) -> Optional[BitsAndBytesConfig]:
+    if QUANT is None:
+        return None
+    if device != "cuda":
+        raise RuntimeError(f"QUANT={QUANT} requires CUDA (bitsandbytes), but device is {device}.")
+    if QUANT == "int8":
+        return BitsAndBytesConfig(load_in_8bit=True)
+    if QUANT == "nf4":
+        return BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_compute_dtype=dtype,
+            bnb_4bit_quant_type="nf4",
+        )
+    raise RuntimeError(f"Unknown QUANT={QUANT!r}. Expected 'int8' or 'nf4'.")
+
+
+def _load_causal_lm(
+    source: str,
+    dtype: torch.dtype,
+    is_local: bool,
+    device: str,
+    quantization_config: Optional[BitsAndBytesConfig] = None,
+) -> torch.nn.Module:
+    kwargs = dict(
+        torch_dtype=dtype,
+        # на Mac лучше без device_map; квантизованные веса bitsandbytes размещает сам
+        device_map=device if quantization_config is not None else None,
+        quantization_config=quantization_config,
+        trust_remote_code=True,
+        local_files_only=is_local,
+    )
+    if USE_FLASH:
+        try:
+            return AutoModelForCausalLM.from_pretrained(
+                source, attn_implementation="flash_attention_2", **kwargs
+            )
+        except (ImportError, ValueError):
+            # flash-attn не установлен или не поддерживает устройство/dtype — откатываемся на SDPA
+            pass
+    try:
+        return AutoModelForCausalLM.from_pretrained(source, attn_implementation="sdpa", **kwargs)
+    except ValueError:
+        # архитектура без поддержки SDPA (например, trust_remote_code-модель)
+        return AutoModelForCausalLM.from_pretrained(source, attn_implementation="eager", **kwargs)
+
+
+def _to_bettertransformer(model: torch.nn.Module) -> torch.nn.Module:
+    # Fused-attention через optimum для eager-моделей на CPU; optimum — опциональная зависимость
+    try:
+        from optimum.bettertransformer import BetterTransformer
+    except ImportError:
+        return model
+    try:
+        return BetterTransformer.transform(model)
+    except (NotImplementedError, ValueError):
+        # архитектура не поддерживается BetterTransformer
+        return model
+
+
+def _compile_model(model: torch.nn.Module, tokenizer, device: str) -> None:
+    model.generation_config.cache_implementation = "static"
+    model.generation_config.disable_compile = True  # компилируем сами, без авто-компиляции в generate
+    model.forward = torch.compile(
+        model.forward,
+        mode="reduce-overhead" if device == "cuda" else "default",
+        fullgraph=True,
+    )
+
+    # Прогрев. Первый прогон выделяет статический кэш на MAX_CTX для батча из одного запроса —
+    # generate переиспользует его для всех запросов покороче. Ещё два прогона с разной короткой
+    # длиной промпта: на втором dynamo перекомпилирует prefill с динамической длиной
+    # последовательности, и реальные промпты новых перекомпиляций уже не вызывают
+    for length in (MAX_CTX - 2, 32, 64):
+        dummy = torch.full((1, length), tokenizer.pad_token_id, device=device)
+        with torch.no_grad():
+            model.generate(
+                input_ids=dummy,
+                attention_mask=torch.ones_like(dummy),
+                max_new_tokens=2,
+                min_new_tokens=2,
+                do_sample=False,
+                pad_token_id=tokenizer.pad_token_id,
+            )
+
+
+def _load_hf(source: str, is_local: bool, device: str, dtype: torch.dtype, label: str) -> ModelBundle:
+    # Важно: для локальной папки source — это путь, и AutoTokenizer/AutoModel умеют это.
+    tokenizer = AutoTokenizer.from_pretrained(
+        source,
+        trust_remote_code=True,
+        local_files_only=is_local,
+    )
+    # Батчевая генерация: паддинг слева, чтобы новые токены шли сразу за промптом
+    tokenizer.padding_side = "left"
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+
+    quantization_config = _quantization_config(device, dtype)
+    model = _load_causal_lm(source, dtype, is_local, device, quantization_config)
+    model.eval()
+    if quantization_config is None:
+        model.to(device)
+    # С SDPA BetterTransformer ничего не добавляет — он нужен только там, где остался eager
+    if device == "cpu" and model.config._attn_implementation == "eager":
+        model = _to_bettertransformer(model)
+    if USE_COMPILE:
+        _compile_model(model, tokenizer, device)
+
+    # Прогрев токенизатора (ленивая инициализация), чтобы её не платил первый запрос
+    tokenizer(["Вердикт: верно", "Пояснение: ..."], return_tensors="pt", padding=True)
+    if device == "cuda":
+        torch.cuda.synchronize()
+
+    return ModelBundle(
+        model=model,
+        tokenizer=tokenizer,
+        device=device,
+        dtype=dtype,
+        source=label,
+        compiled=USE_COMPILE,
+        quantization=QUANT,
+    )
+
+
+def _load_vllm(source: str, device: str, dtype: torch.dtype, label: str) -> ModelBundle:
+    # vllm — опциональная зависимость, нужна только для BACKEND=vllm
+    from vllm import LLM
+
+    llm = LLM(
+        model=source,
+        dtype=str(dtype).removeprefix("torch."),
+        max_model_len=MAX_CTX,
+        trust_remote_code=True,
+        enable_prefix_caching=True,
+    )
+    return ModelBundle(
+        model=llm,
+        tokenizer=llm.get_tokenizer(),
+        device=device,
+        dtype=dtype,
+        source=label,
+        backend="vllm",
+    )
+
+
+def cache_prompt_prefix(bundle: ModelBundle, prefix: str) -> None:
+    """
+    Один раз прогоняет общий для всех запросов префикс промпта и сохраняет его KV-кэш,
+    чтобы generate не делал его prefill заново на каждом запросе.
+    """
+    if bundle.backend != "hf" or bundle.compiled:
+        # vLLM кэширует префиксы сам (enable_prefix_caching),
+        # а статический кэш нельзя совместить с переданным past_key_values
+        return
+
+    try:
+        prefix_ids = bundle.tokenizer(prefix, return_tensors="pt").input_ids.to(bundle.model.device)
+        with torch.no_grad():
+            out = bundle.model(input_ids=prefix_ids, use_cache=True)
+    except Exception as e:
+        # Префиксный кэш — только оптимизация: без него generate просто считает промпт целиком
+        bundle.prefix_error = f"{type(e).__name__}: {e}"
+        return
+
+    bundle.prefix = prefix
+    bundle.prefix_ids = prefix_ids
+    bundle.prefix_cache = out.past_key_values
+
+
 def get_model() -> Optional[ModelBundle]:
     global _MODEL, _LOAD_ERROR
     if _MODEL is not None:
         return _MODEL
 
-    try:
-        source, is_local = _resolve_source()
-        device, dtype = _pick_device_and_dtype()
-
-        # Важно: для локальной папки source — это путь, и AutoTokenizer/AutoModel умеют это.
-        tokenizer = AutoTokenizer.from_pretrained(
-            source,
-            trust_remote_code=True,
-            local_files_only=is_local,
-        )
+    # Конкурентные первые вызовы не должны грузить модель дважды
+    with _LOAD_LOCK:
+        if _MODEL is not None:
+            return _MODEL
 
-        model = AutoModelForCausalLM.from_pretrained(
-            source,
-            torch_dtype=dtype,
-            device_map=None,  # на Mac лучше без device_map
-            trust_remote_code=True,
-            local_files_only=is_local,
-        )
-        model.eval()
-        model.to(device)
+        try:
+            source, is_local = _resolve_source()
+            device, dtype = _pick_device_and_dtype()
+            label = source if not is_local else f"local:{source}"
 
-        _MODEL = ModelBundle(
-            model=model,
-            tokenizer=tokenizer,
-            device=device,
-            dtype=dtype,
-            source=source if not is_local else f"local:{source}",
-        )
-        _LOAD_ERROR = None
-        return _MODEL
+            if BACKEND == "hf":
+                _MODEL = _load_hf(source, is_local, device, dtype, label)
+            elif BACKEND == "vllm":
+                _MODEL = _load_vllm(source, device, dtype, label)
+            else:
+                raise RuntimeError(f"Unknown BACKEND={BACKEND!r}. Expected 'hf' or 'vllm'.")
+            _LOAD_ERROR = None
+            return _MODEL
 
-    except Exception as e:
-        _MODEL = None
-        _LOAD_ERROR = f"{type(e).__name__}: {e}"
-        return None
+        except Exception as e:
+            _MODEL = None
+            _LOAD_ERROR = f"{type(e).__name__}: {e}"
+            return None